@@ -24,10 +24,11 @@ __author__="Chris Smith, from code by Martin Fiedler"
     * Initial port of Martin Fiedler's shuffle database generator to Python 3.
 """
 
-import sys,os,os.path,array,getopt,random,types,fnmatch,operator,string
+import sys,os,os.path,array,getopt,random,types,fnmatch,operator,string,stat,threading
 from functools import reduce
 
 KnownProps=('filename','size','ignore','type','shuffle','reuse','bookmark')
+PlayableTypes=(".mp3",".m4a",".m4b",".m4p",".aa",".wav")
 Rules=[
   ([('filename','~','*.mp3')],          {'type':1, 'shuffle':1, 'bookmark':0}),
   ([('filename','~','*.m4?')],          {'type':2, 'shuffle':1, 'bookmark':0}),
@@ -194,13 +195,13 @@ def rename_safely(path,name):
   return newname
 
 
-def write_to_db(filename):
+def write_to_db(filename,size=None):
   global iTunesSD,domains,total_count,KnownEntries,Rules
 
   # set default properties
   props={
     'filename': filename,
-    'size': filesize(filename[1:]),
+    'size': filesize(filename[1:]) if size is None else size,
     'ignore': 0,
     'type': 1,
     'shuffle': 1,
@@ -230,25 +231,142 @@ def write_to_db(filename):
   return 1
 
 
-def file_entry(path,name,prefix=""):
+def file_kind(path,name):
+  # 0 for a directory, 1 for a playable file, None for anything we skip
   if not(name) or name[0]==".": return None
   fullname="%s/%s"%(path,name)
-  may_rename=not(fullname.startswith("./iPod_Control")) and Options['rename']
   try:
     if os.path.islink(fullname):
       return None
     if os.path.isdir(fullname):
-      if may_rename: name=rename_safely(path,name)
-      return (0,prefix+name)
-    if os.path.splitext(name)[1].lower() in (".mp3",".m4a",".m4b",".m4p",".aa",".wav"):
-      if may_rename: name=rename_safely(path,name)
-      return (1,prefix+name)
+      return 0
+    if os.path.splitext(name)[1].lower() in PlayableTypes:
+      return 1
   except OSError:
     pass
   return None
 
 
-def browse(path, interactive):
+def named_entry(path,name,kind,prefix="",size=None):
+  if Options['rename'] and not("%s/%s"%(path,name)).startswith("./iPod_Control"):
+    name=rename_safely(path,name)
+  return (kind,prefix+name,size)
+
+
+def file_entry(path,name,prefix=""):
+  kind=file_kind(path,name)
+  if kind is None: return None
+  return named_entry(path,name,kind,prefix)
+
+
+def scan_dir(path):
+  # Same classification as file_kind(), but with a single lstat() per entry so
+  # the file size comes along for free.  Never renames anything, since the
+  # user may still reject the directory.
+  try:
+    names=os.listdir(path)
+  except OSError:
+    return None
+  listing=[]
+  for name in names:
+    if not(name) or name[0]==".": continue
+    try:
+      st=os.lstat("%s/%s"%(path,name))
+    except OSError:
+      st=None
+    if st and stat.S_ISLNK(st.st_mode):
+      continue
+    if st and stat.S_ISDIR(st.st_mode):
+      listing.append((name,0,None))
+    elif os.path.splitext(name)[1].lower() in PlayableTypes:
+      listing.append((name,1,st and st.st_size))
+  return sorted(listing,key=lambda x: x[0].lower())
+
+
+class Prefetcher:
+  """Walk the directory tree in a background thread, in the same order that
+  browse() visits it, so the listings are ready by the time the user has
+  answered the prompt for a directory."""
+
+  def __init__(self,roots):
+    self.cond=threading.Condition()
+    self.pending=[]
+    for root in reversed(roots):
+      if root[-1]=="/": root=root[:-1]
+      if not root in self.pending: self.pending.append(root)
+    self.cache={}
+    self.wanted=None    # path browse() is waiting for, scanned before pending
+    self.scanning=None  # path the walker is listing right now
+    self.discard=False  # set when that path is dropped mid-scan
+    self.error=None
+    self.closed=False
+    self.thread=threading.Thread(target=self.run,daemon=True)
+    self.thread.start()
+
+  def run(self):
+    try:
+      self.walk()
+    except Exception as e:
+      with self.cond:
+        self.error=e
+        self.scanning=None
+        self.cond.notify_all()
+
+  def walk(self):
+    while 1:
+      with self.cond:
+        while not(self.wanted or self.pending or self.closed):
+          self.cond.wait()
+        if self.closed: return
+        if self.wanted:
+          path,self.wanted=self.wanted,None
+        else:
+          path=self.pending.pop()
+        self.scanning=path
+        self.discard=False
+      listing=scan_dir(path)
+      with self.cond:
+        self.scanning=None
+        if not(self.discard or path in self.cache):
+          self.cache[path]=listing
+          # push in reverse so the first subdirectory is scanned next
+          for name,kind,size in reversed(listing or []):
+            if not kind: self.pending.append("%s/%s"%(path,name))
+        self.cond.notify_all()
+
+  def listdir(self,path):
+    "Return the scan_dir() listing for path, waiting for it if necessary."
+    with self.cond:
+      if not(path in self.cache or path==self.scanning):
+        # not there yet: have the walker scan it next
+        if path in self.pending: self.pending.remove(path)
+        self.wanted=path
+        self.cond.notify_all()
+      while not path in self.cache:
+        if self.error is not None:
+          raise self.error
+        if path==self.scanning: self.discard=False
+        self.cond.wait()
+      return self.cache.pop(path)
+
+  def drop(self,path):
+    "Forget path and everything below it, and stop scanning there."
+    def below(p):
+      return p==path or p.startswith(path+"/")
+    with self.cond:
+      self.pending=[p for p in self.pending if not below(p)]
+      for p in [p for p in self.cache if below(p)]:
+        del self.cache[p]
+      if self.scanning and below(self.scanning):
+        self.discard=True
+
+  def close(self):
+    with self.cond:
+      self.closed=True
+      self.cond.notify_all()
+
+
+def browse(path, interactive, prefetch=None):
   global domains
 
   if path[-1]=="/": path=path[:-1]
@@ -268,18 +386,37 @@ def browse(path, interactive):
       if choice in "yjos":  # yes/ja/oui/si
         break
       if choice in "n":     # no/nein/non/non?
+        if prefetch: prefetch.drop(path)
         return 0
 
-  try:
-    files=filter(None,[file_entry(path,name) for name in os.listdir(path)])
-  except OSError:
-    return
+  if prefetch:
+    listing=prefetch.listdir(path)
+    if listing is None:
+      return
+    files=[]
+    for name,kind,size in listing:
+      entry=named_entry(path,name,kind,size=size)
+      if entry[1]!=name:  # renamed, so the prefetched subtree is stale
+        prefetch.drop("%s/%s"%(path,name))
+      files.append(entry)
+  else:
+    try:
+      files=filter(None,[file_entry(path,name) for name in os.listdir(path)])
+    except OSError:
+      return
 
   if path=="./iPod_Control/Music":
     subdirs=[x[1] for x in files if not x[0]]
-    files=list(filter(lambda x: x[0], files))
+    # only the files in the subdirectories of Music/ get indexed, like the
+    # non-interactive listing (its iterator is used up by subdirs above)
+    files=[] if prefetch else list(filter(lambda x: x[0], files))
     for dir in subdirs:
       subpath="%s/%s"%(path,dir)
+      if prefetch:
+        listing=prefetch.listdir(subpath)
+        prefetch.drop(subpath)
+        files.extend([named_entry(subpath,name,kind,dir+"/",size) for name,kind,size in listing or [] if kind])
+        continue
       try:
         files.extend(filter(lambda x: x and x[0],[file_entry(subpath,name,dir+"/") for name in os.listdir(subpath)]))
       except OSError:
@@ -296,9 +433,9 @@ def browse(path, interactive):
   for item in files:
     fullname="%s/%s"%(path,item[1])
     if item[0]:
-      real_count+=write_to_db(fullname[1:])
+      real_count+=write_to_db(fullname[1:],item[2])
     else:
-      browse(fullname,interactive)
+      browse(fullname,interactive,prefetch)
 
   if real_count==count:
     log("%s: %d files"%(displaypath,count))
@@ -551,12 +688,16 @@ Please make sure that:
   del header[:18]
 
   log("Searching for files on your iPod.")
+  roots=["./"+dir for dir in dirs] or ["."]
+  prefetch=None
+  if Options['interactive']:
+    prefetch=Prefetcher(roots)
   try:
-    if dirs:
-      for dir in dirs:
-        browse("./"+dir,Options['interactive'])
-    else:
-      browse(".",Options['interactive'])
+    try:
+      for root in roots:
+        browse(root,Options['interactive'],prefetch)
+    finally:
+      if prefetch: prefetch.close()
     log("%d playable files were found on your iPod."%total_count)
     log()
     log("Fixing iTunesSD header.")